@@ -25,12 +25,20 @@ VERSION = "1.0.0"
 
 import argparse
 import csv
+import functools
 import hashlib
-import multiprocessing
+import json
 import os
 import requests
+import shutil
+import socket
+import subprocess
 import sys
 import time
+import urllib3
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Constants
@@ -41,6 +49,55 @@ DEFAULT_DOWNLOAD_JOBS = 100
 # This is the number of parallel jobs to download from hex.pm for the index. This server is rate limited so setting
 # this too high will slow things down.
 API_PULL_JOBS = 25
+# Timeout in seconds for connecting to and reading from the servers
+HTTP_TIMEOUT = 30
+# Timeout in seconds for requests to the hex.pm API. The index pages are small so a stalled request is retried sooner
+API_TIMEOUT = 15
+# Downloads are streamed to disk through a buffer of this size rather than being held in memory in full
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Files are read in chunks of this size when hashing on Python versions without hashlib.file_digest
+HASH_CHUNK_SIZE = 64 * 1024
+# Files are downloaded to a temporary file with this suffix and only renamed to their final name once complete
+PARTIAL_SUFFIX = ".part"
+# Partially downloaded tarballs are resumed from where they stopped rather than being downloaded again in full
+TARBALLS_URL = "https://repo.hex.pm/tarballs/"
+# The ETag or Last-Modified of a partially downloaded tarball is kept in a file alongside it with this suffix added to
+# the partial file name. It is sent as If-Range when resuming so a tarball that was republished is downloaded afresh.
+VALIDATOR_SUFFIX = ".validator"
+# Name of the file in the download directory that records the ETag of each downloaded file. These are sent with
+# If-None-Match on later runs so that unchanged files are not transferred again.
+ETAGS_FILENAME = ".download-hexpm-etags.json"
+# Name of the file in the download directory that caches the package list and the time of the most recently updated
+# package in it. Later runs only fetch the packages that have been updated since then and merge them into the cache.
+INDEX_FILENAME = ".download-hexpm-index.json"
+# The whole package list is downloaded again when the cached one was last downloaded in full more than this many
+# seconds ago. This drops packages that have been removed from hex.pm, which an update can't detect.
+FULL_INDEX_MAX_AGE = 7 * 24 * 60 * 60
+# Name of the aria2c input file written to the download directory when downloading with --aria2
+ARIA2_INPUT_FILENAME = ".download-hexpm-aria2.input"
+# aria2c writes to the final file name and keeps a control file with this suffix alongside it until the download has
+# completed. A file with a control file is incomplete and is downloaded again.
+ARIA2_CONTROL_SUFFIX = ".aria2"
+# Results returned by download_file
+DOWNLOADED = "Downloaded"
+NOT_MODIFIED = "Not modified"
+FAILED = "Failed to download"
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Globals
+# ----------------------------------------------------------------------------------------------------------------------
+
+# HTTP session shared by all requests to repo.hex.pm so that connections are kept alive and reused rather than doing a
+# new TCP and TLS handshake for every file. This is replaced using init_sessions once the number of parallel jobs is
+# known.
+SESSION = requests.Session()
+# HTTP session shared by the index jobs for requests to the hex.pm API. This is separate from SESSION so its pool is
+# sized for API_PULL_JOBS and the download pool is sized purely by the number of download jobs.
+API_SESSION = requests.Session()
+# The uncached socket.getaddrinfo. This is replaced by cached_getaddrinfo while downloading
+SOCKET_GETADDRINFO = socket.getaddrinfo
+# ETags of downloaded files keyed by URL. Loaded from and saved to ETAGS_FILENAME in the download directory
+ETAGS: dict[str, str] = {}
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Functions
@@ -56,20 +113,134 @@ def error(message: str) -> None:
     exit(1)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: create_session
+#
+#   Creates a requests session with a connection pool big enough for pool_size parallel jobs. Connection failures and
+#   server errors are retried a few times with a backoff before the response is returned to the caller.
+# ----------------------------------------------------------------------------------------------------------------------
+def create_session(pool_size: int) -> requests.Session:
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: init_sessions
+#
+#   Replaces the shared sessions with ones sized for num_download_jobs parallel downloads and API_PULL_JOBS parallel
+#   index requests
+# ----------------------------------------------------------------------------------------------------------------------
+def init_sessions(num_download_jobs: int) -> None:
+    global SESSION, API_SESSION
+    SESSION = create_session(num_download_jobs)
+    API_SESSION = create_session(API_PULL_JOBS)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: cached_getaddrinfo
+#
+#   Caching replacement for socket.getaddrinfo. Every connection made is to either hex.pm or repo.hex.pm so each name
+#   only needs resolving once per run rather than once for every new connection. Failed lookups are not cached.
+# ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def cached_getaddrinfo(*args, **kwargs) -> list:
+    return SOCKET_GETADDRINFO(*args, **kwargs)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: load_etags
+#
+#   Loads the ETags recorded by a previous run from the download directory. If there are none then no downloads will be
+#   conditional
+# ----------------------------------------------------------------------------------------------------------------------
+def load_etags(download_dir: str) -> None:
+    global ETAGS
+    etags_file = os.path.join(download_dir, ETAGS_FILENAME)
+    ETAGS = {}
+    if os.path.isfile(etags_file):
+        try:
+            with open(etags_file, "r") as f:
+                ETAGS = {url: etag for (url, etag) in json.load(f).items() if not url.startswith(TARBALLS_URL)}
+        except ValueError:
+            print("Ignoring invalid ETags file: %s" % etags_file)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: save_etags
+#
+#   Saves the ETags of the downloaded files to the download directory for use by the next run
+# ----------------------------------------------------------------------------------------------------------------------
+def save_etags(download_dir: str) -> None:
+    etags_file = os.path.join(download_dir, ETAGS_FILENAME)
+    with open(etags_file + PARTIAL_SUFFIX, "w") as f:
+        json.dump(ETAGS, f)
+    os.replace(etags_file + PARTIAL_SUFFIX, etags_file)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: load_index
+#
+#   Loads the package list cached by a previous run from the download directory. Returns a tuple of format
+#   ( PACKAGES, UPDATED_AT, FULL_FETCH_TIME )
+#   where PACKAGES is a dictionary of package name to versions, UPDATED_AT is the time of the most recently updated
+#   package, and FULL_FETCH_TIME is when the whole list was last downloaded (as from time.time). If there is no cached
+#   package list then the dictionary and times are empty
+# ----------------------------------------------------------------------------------------------------------------------
+def load_index(download_dir: str) -> tuple[dict[str, tuple[str, ...]], str, float]:
+    index_file = os.path.join(download_dir, INDEX_FILENAME)
+    if os.path.isfile(index_file):
+        try:
+            with open(index_file, "r") as f:
+                index = json.load(f)
+            packages = {
+                name: tuple(sys.intern(version) for version in versions)
+                for (name, versions) in index["packages"].items()
+            }
+            return (packages, index["updated_at"], index.get("full_fetch_time", 0.0))
+        except (ValueError, KeyError):
+            print("Ignoring invalid package list file: %s" % index_file)
+    return ({}, "", 0.0)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: save_index
+#
+#   Saves the package list, the time of the most recently updated package, and the time the whole list was last
+#   downloaded to the download directory for use by the next run
+# ----------------------------------------------------------------------------------------------------------------------
+def save_index(
+    download_dir: str, packages: dict[str, tuple[str, ...]], updated_at: str, full_fetch_time: float
+) -> None:
+    os.makedirs(download_dir, exist_ok=True)
+    index_file = os.path.join(download_dir, INDEX_FILENAME)
+    with open(index_file + PARTIAL_SUFFIX, "w") as f:
+        json.dump({"updated_at": updated_at, "full_fetch_time": full_fetch_time, "packages": packages}, f)
+    os.replace(index_file + PARTIAL_SUFFIX, index_file)
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: download_package_page
 #
-#   Downloads a packages page and returns json data as list. Empty list if page does not exist
+#   Downloads a packages page and returns a list of tuples of format ( NAME, VERSIONS, UPDATED_AT ) for each package on
+#   the page. Only the package name, release versions, and update time are kept from the json as that is all that is
+#   needed to determine the files in the repo. Pages are sorted with the most recently updated packages first.
+#   Empty list if page does not exist
 # ----------------------------------------------------------------------------------------------------------------------
-def download_package_page(page: int) -> list[dict]:
-    url = "https://hex.pm/api/packages?page=%u" % page
+def download_package_page(page: int) -> list[tuple[str, tuple[str, ...], str]]:
+    url = "https://hex.pm/api/packages?page=%u&sort=updated_at" % page
     code = 429
-    page_data: list[dict] = []
+    page_data: list[tuple[str, tuple[str, ...], str]] = []
     while code == 429:
-        r = requests.get(url)
+        r = API_SESSION.get(url, timeout=API_TIMEOUT)
         code = r.status_code
         if code == 200:
-            page_data = r.json()
+            for package in r.json():
+                # Most version strings (eg 0.1.0) are used by many packages so they are interned to only store each once
+                versions = tuple(sys.intern(release["version"]) for release in package["releases"])
+                page_data.append((package["name"], versions, package["updated_at"]))
         if code == 429:
             # Rate limited. So pause a second and try again.
             time.sleep(1)
@@ -82,141 +253,315 @@ def download_package_page(page: int) -> list[dict]:
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: get_full_repo_data
 #
-#   Returns a list of dictionary items containing the full json of the repo list
-# ----------------------------------------------------------------------------------------------------------------------
-def get_full_repo_data() -> list[dict]:
-    full_list = []
+#   Returns a list of tuples of format ( NAME, VERSIONS ) for every package in the repo.
+#   The package list from the previous run is loaded from the download directory and only the packages updated since
+#   then are downloaded and merged into it. The whole list is downloaded again if full_index is set or the last full
+#   download was more than FULL_INDEX_MAX_AGE ago, as an incremental update never sees packages removed from the repo.
+#   Up to API_PULL_JOBS pages are kept in flight. Each time a page arrives the next page is requested, until a blank
+#   page or a package older than the previous run is reached, so one slow or rate limited page does not hold up the
+#   others.
+#   When updating a previous list this starts with a single page and grows as usually only the first page has changed.
+# ----------------------------------------------------------------------------------------------------------------------
+def get_full_repo_data(download_dir: str, full_index: bool) -> list[tuple[str, tuple[str, ...]]]:
+    (packages, last_updated_at, full_fetch_time) = load_index(download_dir)
+    if full_index or time.time() - full_fetch_time > FULL_INDEX_MAX_AGE:
+        (packages, last_updated_at, full_fetch_time) = ({}, "", time.time())
+    pages: dict[int, list[tuple[str, tuple[str, ...], str]]] = {}
     print("Downloading package list: ", end="")
     last_page = False
-    page_block_index = 1
-    with multiprocessing.Pool(API_PULL_JOBS) as process_multitasker:
-        while not last_page:
-            page_indexes = range(page_block_index, page_block_index + API_PULL_JOBS)
-            print(".", end="")
-            pages = process_multitasker.map(download_package_page, page_indexes, 1)
-            for data in pages:
+    with ThreadPoolExecutor(max_workers=API_PULL_JOBS) as executor:
+        in_flight: dict[Future, int] = {}
+        for next_page in range(1, (API_PULL_JOBS if not last_updated_at else 1) + 1):
+            in_flight[executor.submit(download_package_page, next_page)] = next_page
+        while in_flight:
+            (done, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                page = in_flight.pop(future)
+                data = future.result()
                 if data:
-                    full_list.extend(data)
+                    print(".", end="")
+                    pages[page] = data
+                    if data[-1][2] < last_updated_at:
+                        # Reached packages that have not been updated since the previous run
+                        last_page = True
+                    if not last_page:
+                        next_page += 1
+                        in_flight[executor.submit(download_package_page, next_page)] = next_page
+                    if not last_page and len(in_flight) < API_PULL_JOBS:
+                        next_page += 1
+                        in_flight[executor.submit(download_package_page, next_page)] = next_page
                 else:
                     # Reached blank page
                     last_page = True
-            page_block_index += API_PULL_JOBS
     print("")
 
-    return full_list
+    # Pages can complete in any order so merge them in page order, most recently updated first, so if a package moved
+    # pages while downloading the earlier newer copy is kept
+    updated_at = last_updated_at
+    merged_packages: set[str] = set()
+    num_updated = 0
+    for page in sorted(pages):
+        for (name, versions, package_updated_at) in pages[page]:
+            if name not in merged_packages:
+                merged_packages.add(name)
+                packages[name] = versions
+                if package_updated_at > last_updated_at:
+                    num_updated += 1
+                updated_at = max(updated_at, package_updated_at)
+    if last_updated_at:
+        print("%u packages updated since previous run" % num_updated)
+    save_index(download_dir, packages, updated_at, full_fetch_time)
+
+    return list(packages.items())
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: get_files_in_dir
+#
+#   Returns the set of names in a directory. An empty set is returned if the directory does not exist.
+#   This is used to check for existing files with a single directory listing rather than a stat call per file. The
+#   directories this is used on only contain files so the entries are not checked for type.
+# ----------------------------------------------------------------------------------------------------------------------
+def get_files_in_dir(dir: str) -> set[str]:
+    if not os.path.isdir(dir):
+        return set()
+    return set(os.listdir(dir))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: determine_files_to_download
 #
-#   Takes the complete json of the repo and determines every file that needs to be downloaded and then checks if they
-#   already are downloaded. The list returned contains files that need to be downloaded.
-#   Note if there are any tarballs in a package that need downloading the package file itself is included for redownload
-#   This returns of list of tuples of format
+#   Takes the complete package list of the repo and determines every file that needs to be downloaded and then checks if
+#   they already are downloaded. The list returned contains files that need to be downloaded.
+#   Note the package files are always included as they change when releases are added or retired. They are downloaded
+#   with a conditional request so they are only transferred again if they have changed.
+#   The total number of files in the repo is counted in the same pass.
+#   This returns a tuple of format
+#   ( FILES_TO_DOWNLOAD, TOTAL_COUNT )
+#   where FILES_TO_DOWNLOAD is a list of tuples of format
 #   ( URL, FILEPATH )
 # ----------------------------------------------------------------------------------------------------------------------
-def determine_files_to_download(full_list: list[dict], download_dir: str) -> list[tuple[str, str]]:
+def determine_files_to_download(
+    full_list: list[tuple[str, tuple[str, ...]]], download_dir: str
+) -> tuple[list[tuple[str, str]], int]:
     files_to_download: list[tuple[str, str]] = []
-    for package in full_list:
-        name = package["name"]
+    total_count = 0
+    # The directories are joined once here rather than for every file as this loop runs for every release in the repo
+    tarballs_dir = os.path.join(download_dir, "tarballs") + os.sep
+    packages_dir = os.path.join(download_dir, "packages") + os.sep
+    existing_tarballs = get_files_in_dir(tarballs_dir)
+    for (name, versions) in full_list:
+        total_count += 1 + len(versions)
 
-        package_url = "https://repo.hex.pm/packages/%s" % name
-        local_package_file = os.path.join(download_dir, "packages", name)
-        include_package = False
+        for version in versions:
+            tarball = "%s-%s.tar" % (name, version)
+            if tarball not in existing_tarballs or tarball + ARIA2_CONTROL_SUFFIX in existing_tarballs:
+                files_to_download.append((TARBALLS_URL + tarball, tarballs_dir + tarball))
 
-        for release in package["releases"]:
-            version = release["version"]
-            tarball_url = "https://repo.hex.pm/tarballs/%s-%s.tar" % (name, version)
-            local_file = os.path.join(download_dir, "tarballs", "%s-%s.tar" % (name, version))
-            if not os.path.isfile(local_file):
-                files_to_download.append((tarball_url, local_file))
-                include_package = True
+        files_to_download.append(("https://repo.hex.pm/packages/" + name, packages_dir + name))
 
-        if include_package or not os.path.isfile(local_package_file):
-            files_to_download.append((package_url, local_package_file))
-
-    return files_to_download
-
-
-# ----------------------------------------------------------------------------------------------------------------------
-#   Function: get_total_count_of_files
-#
-#   Takes the complete json of the repo and counts the total number of files in the repo
-# ----------------------------------------------------------------------------------------------------------------------
-def get_total_count_of_files(full_list: list[dict]) -> int:
-    num_files = 0
-    for package in full_list:
-        num_files += 1
-        for release in package["releases"]:
-            num_files += 1
-    return num_files
+    return (files_to_download, total_count)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: download_file
 #
 #   Downloads a file from a URL and saves it to specified location. File only saved if full file downloaded.
-#   This will replace any existing file
-# ----------------------------------------------------------------------------------------------------------------------
-def download_file(index_total_url_and_file: tuple[int, int, str, str]) -> None:
-    (index, total, url, filepath) = index_total_url_and_file
-    r = requests.get(url)
-    if r.status_code == 200:
+#   This will replace any existing file. The file is streamed into a partial file alongside the destination which is
+#   renamed over the destination once complete, so an interrupted download never looks like a complete file.
+#   If the file exists and its ETag is known then the request is conditional and the file is left alone if the server
+#   reports it has not been modified.
+#   Tarballs are resumable. If a tarball download fails the partial file is kept, along with the ETag or Last-Modified
+#   of the response, and the next attempt requests only the remainder of the file if it has not changed since. Other
+#   files may change so their partial files are removed on failure.
+#   Returns one of DOWNLOADED, NOT_MODIFIED, or FAILED. Progress is reported by the caller.
+# ----------------------------------------------------------------------------------------------------------------------
+def download_file(url: str, filepath: str) -> str:
+    partial_filepath = filepath + PARTIAL_SUFFIX
+    validator_filepath = partial_filepath + VALIDATOR_SUFFIX
+    resumable = url.startswith(TARBALLS_URL)
+    headers = {}
+    if url in ETAGS and os.path.isfile(filepath):
+        headers["If-None-Match"] = ETAGS[url]
+    resume_from = 0
+    if resumable:
         try:
-            with open(filepath, "w+b") as f:
-                f.write(r.content)
-                print("Downloaded [%u/%u]: %s" % (index, total, url))
-        except:
-            print("Removing partially saved file: %s" % filepath)
-            os.remove(filepath)
-    else:
-        print("Failed to download: %s" % url)
+            resume_from = os.path.getsize(partial_filepath)
+            with open(validator_filepath, "r") as f:
+                validator = f.read()
+        except OSError:
+            # Without both the partial file and its validator the download can't be resumed safely so start afresh
+            resume_from = 0
+    if resume_from:
+        headers["Range"] = "bytes=%u-" % resume_from
+        # If the tarball has changed since the partial file was started the server sends the whole new file instead
+        headers["If-Range"] = validator
+        # The range must refer to the bytes as stored, so the response cannot be compressed
+        headers["Accept-Encoding"] = "identity"
+    try:
+        with SESSION.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+            if r.status_code == 304:
+                return NOT_MODIFIED
+            content_range = r.headers.get("Content-Range", "")
+            if r.status_code == 206 and resume_from and content_range.startswith("bytes %u-" % resume_from):
+                mode = "ab"
+            elif r.status_code == 416 and resume_from and content_range == "bytes */%u" % resume_from:
+                # The partial file is already the full length of the unchanged tarball
+                mode = ""
+            elif r.status_code == 200:
+                mode = "wb"
+                if resumable:
+                    validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+                    if validator:
+                        with open(validator_filepath, "w") as f:
+                            f.write(validator)
+                    elif os.path.isfile(validator_filepath):
+                        os.remove(validator_filepath)
+            else:
+                if resume_from:
+                    # The partial file could not be resumed (eg the server sent a different range) so start again next
+                    # time
+                    os.remove(partial_filepath)
+                    os.remove(validator_filepath)
+                return FAILED
+            if mode:
+                # Copy straight from the socket to the file. Content-Encoding is still decoded as iter_content would
+                r.raw.decode_content = True
+                with open(partial_filepath, mode) as f:
+                    shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            etag = r.headers.get("ETag")
+        os.replace(partial_filepath, filepath)
+        if resumable and os.path.isfile(validator_filepath):
+            os.remove(validator_filepath)
+        # Tarballs are never requested conditionally as existing ones are not downloaded again, so their ETags are not
+        # recorded
+        if etag and not url.startswith(TARBALLS_URL):
+            ETAGS[url] = etag
+        else:
+            ETAGS.pop(url, None)
+        return DOWNLOADED
+    except (requests.RequestException, urllib3.exceptions.HTTPError, OSError):
+        # Errors while reading the body come from urllib3 directly as r.raw is read without going through requests
+        if not resumable and os.path.isfile(partial_filepath):
+            print("Removing partially saved file: %s" % partial_filepath)
+            os.remove(partial_filepath)
+        return FAILED
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: ensure_folders_exist
 #
 #   Takes a list of tuples of format ( URL, FILEPATH ) and makes sure the folders for FILEPATH exist. If they don't
-#   they will be created
-# ----------------------------------------------------------------------------------------------------------------------
-def ensure_folders_exist(urls_and_files: list[tuple[str, str]]) -> None:
-    unique_dirs: dict[str, bool] = {}
+#   they will be created. Nearly all files go into the tarballs and packages folders which are created directly, only
+#   the files under installs are spread over a folder per elixir version.
+# ----------------------------------------------------------------------------------------------------------------------
+def ensure_folders_exist(download_dir: str, urls_and_files: list[tuple[str, str]]) -> None:
+    installs_dir = os.path.join(download_dir, "installs")
+    dirs = {
+        download_dir,
+        installs_dir,
+        os.path.join(download_dir, "tarballs"),
+        os.path.join(download_dir, "packages"),
+    }
+    installs_prefix = installs_dir + os.sep
     for (url, filepath) in urls_and_files:
-        dir = os.path.dirname(filepath)
-        if dir not in unique_dirs:
-            os.makedirs(dir, exist_ok=True)
-            unique_dirs[dir] = True
+        if filepath.startswith(installs_prefix):
+            dirs.add(os.path.dirname(filepath))
+    for dir in dirs:
+        os.makedirs(dir, exist_ok=True)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: download_files_in_parallel
 #
 #   Takes a list of tuples of format ( URL, FILEPATH ) and downloads each one using parallel threads for higher
-#   throughput
+#   throughput. The work is entirely network and disk I/O so threads within a single process are used rather than
+#   a process per job. Progress is printed from the calling thread as each download completes.
 # ----------------------------------------------------------------------------------------------------------------------
-def download_files_in_parallel(urls_and_files: list[tuple[str, str]], num_download_jobs: int) -> None:
+def download_files_in_parallel(
+    download_dir: str, urls_and_files: list[tuple[str, str]], num_download_jobs: int
+) -> None:
     totalfiles = len(urls_and_files)
-    ensure_folders_exist(urls_and_files)
-    index_total_url_and_file: list[tuple[int, int, str, str]] = []
-    index = 0
-    for (url, file) in urls_and_files:
-        index += 1
-        index_total_url_and_file.append((index, totalfiles, url, file))
-    with multiprocessing.Pool(num_download_jobs) as p:
-        p.map(download_file, index_total_url_and_file, 1)
+    ensure_folders_exist(download_dir, urls_and_files)
+    load_etags(download_dir)
+    results = {DOWNLOADED: 0, NOT_MODIFIED: 0, FAILED: 0}
+    try:
+        with ThreadPoolExecutor(max_workers=num_download_jobs) as executor:
+            try:
+                futures = {executor.submit(download_file, url, file): url for (url, file) in urls_and_files}
+                index = 0
+                for future in as_completed(futures):
+                    index += 1
+                    result = future.result()
+                    results[result] += 1
+                    print("%s [%u/%u]: %s" % (result, index, totalfiles, futures[future]))
+            except BaseException:
+                # Leaving the with block would otherwise wait for every queued download to run. Cancel the queued
+                # downloads so an interrupt or error stops the run once the downloads in progress finish
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    finally:
+        save_etags(download_dir)
+    print(
+        "Downloaded %u files, %u not modified, %u failed"
+        % (results[DOWNLOADED], results[NOT_MODIFIED], results[FAILED])
+    )
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#   Function: download_files_with_aria2
+#
+#   Takes a list of tuples of format ( URL, FILEPATH ) and downloads them using aria2c rather than from Python. The
+#   list is written out as an aria2c input file and aria2c runs num_download_jobs downloads in parallel.
+#   Files that already exist are only downloaded again if the server has a newer copy, in which case they are replaced
+#   in full. Files left incomplete by a previous run still have their aria2c control file which aria2c resumes from.
+#   They are not preallocated so an incomplete file is never padded out to full size.
+#   Returns True if aria2c completed all the downloads successfully
+# ----------------------------------------------------------------------------------------------------------------------
+def download_files_with_aria2(download_dir: str, urls_and_files: list[tuple[str, str]], num_download_jobs: int) -> bool:
+    ensure_folders_exist(download_dir, urls_and_files)
+    input_file = os.path.join(download_dir, ARIA2_INPUT_FILENAME)
+    with open(input_file, "w") as f:
+        for (url, filepath) in urls_and_files:
+            f.write("%s\n  dir=%s\n  out=%s\n" % (url, os.path.dirname(filepath), os.path.basename(filepath)))
+    try:
+        result = subprocess.run(
+            [
+                "aria2c",
+                "--input-file=%s" % input_file,
+                "--max-concurrent-downloads=%u" % num_download_jobs,
+                "--max-connection-per-server=4",
+                "--conditional-get=true",
+                "--file-allocation=none",
+                "--allow-overwrite=true",
+                "--auto-file-renaming=false",
+                "--console-log-level=warn",
+            ]
+        )
+    finally:
+        os.remove(input_file)
+    return result.returncode == 0
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #   Function: file_with_hash_exists
 #
-#   Determines if the specified file exists and has the correct hash. Returns True if file exists and has specified
-#   sha512 hash. Note the sha512 hash is specified by string
+#   Determines if the specified file exists and has the correct hash. Returns True if file exists and its sha512 hash
+#   is one of the specified hashes. Note the sha512 hashes are specified by string. The file is hashed in chunks so it
+#   is never held in memory in full.
 # ----------------------------------------------------------------------------------------------------------------------
-def file_with_hash_exists(filepath: str, hash: str) -> bool:
+def file_with_hash_exists(filepath: str, hashes: set[str]) -> bool:
     if os.path.isfile(filepath):
         with open(filepath, "rb") as f:
-            filehash = hashlib.sha512(f.read()).hexdigest()
-            if filehash == hash:
+            if hasattr(hashlib, "file_digest"):
+                filehash = hashlib.file_digest(f, "sha512").hexdigest()
+            else:
+                # Python versions before 3.11
+                hasher = hashlib.sha512()
+                while chunk := f.read(HASH_CHUNK_SIZE):
+                    hasher.update(chunk)
+                filehash = hasher.hexdigest()
+            if filehash in hashes:
                 return True
     return False
 
@@ -234,7 +579,7 @@ def download_and_process_hex_csv(
 ) -> list[tuple[str, str]]:
 
     url = "https://repo.hex.pm/installs/%s" % csv_file
-    r = requests.get(url)
+    r = SESSION.get(url, timeout=HTTP_TIMEOUT)
     data = list(csv.DictReader(r.text.split("\n"), fieldnames=["hex_ver", "hash", "elixir_ver"]))
     # Generate list of files to download
     files_to_download = []
@@ -248,19 +593,17 @@ def download_and_process_hex_csv(
         file = os.path.join(download_dir, "installs", elixir_ver, "%s-%s%s" % (file_prefix, hex_ver, file_suffix))
 
         if file not in unique_filepaths:
-            unique_filepaths[file] = {"filepath": file, "url": url, "hashes": []}
-        unique_filepaths[file]["hashes"].append(hash)
-
-    # Now process the unique files/urls and see if we have them downloaded already
-    for file in unique_filepaths:
-        url = unique_filepaths[file]["url"]
-        match = False
-        for hash in unique_filepaths[file]["hashes"]:
-            # See if we have this file already downloaded
-            if file_with_hash_exists(file, hash):
-                match = True
-        if not match:
-            files_to_download.append((url, file))
+            unique_filepaths[file] = {"filepath": file, "url": url, "hashes": set()}
+        unique_filepaths[file]["hashes"].add(hash)
+
+    # Now process the unique files/urls and see if we have them downloaded already. Hashing is done in parallel as
+    # hashlib releases the GIL while hashing so the files can be checked on all cores at once.
+    hashes = [unique_filepaths[file]["hashes"] for file in unique_filepaths]
+    with ThreadPoolExecutor() as executor:
+        matches = executor.map(file_with_hash_exists, unique_filepaths, hashes)
+        for (file, match) in zip(unique_filepaths, matches):
+            if not match:
+                files_to_download.append((unique_filepaths[file]["url"], file))
 
     return files_to_download
 
@@ -318,6 +661,16 @@ def main(argv: list[str]) -> int:
         help="Number of parallel download tasks. (Default %u)" % DEFAULT_DOWNLOAD_JOBS,
     )
     parser.add_argument("--dir", "-d", default="./repo.hex.pm", help="Download directory (Default ./repo.hex.pm)")
+    parser.add_argument(
+        "--full-index",
+        action="store_true",
+        help="Download the whole package list rather than only the packages updated since the previous run",
+    )
+    parser.add_argument(
+        "--aria2",
+        action="store_true",
+        help="Download the files using aria2c if it is installed. Otherwise the files are downloaded by this script",
+    )
     args = parser.parse_args(argv)
 
     num_jobs = args.num_jobs
@@ -326,14 +679,27 @@ def main(argv: list[str]) -> int:
     print("download-hexpm version " + VERSION)
 
     if args.command == "download":
+        init_sessions(num_jobs)
+        socket.getaddrinfo = cached_getaddrinfo
         extra_files_list = get_extra_files_list(download_dir)
-        full_list = get_full_repo_data()
-        total_repo_files = get_total_count_of_files(full_list) + len(extra_files_list)
-        download_list = determine_files_to_download(full_list, download_dir)
-
+        full_list = get_full_repo_data(download_dir, args.full_index)
+        (download_list, total_repo_files) = determine_files_to_download(full_list, download_dir)
+        total_repo_files += len(extra_files_list)
+
+        # Sort by URL so requests for the same part of the site are issued together and reuse the same connections.
+        # The tarballs still go before the package files, and the extra files (which end with the names and versions
+        # index files) go last, so the metadata never refers to tarballs that have not been downloaded yet
+        download_list.sort(key=lambda url_and_file: (not url_and_file[0].startswith(TARBALLS_URL), url_and_file[0]))
         download_list.extend(extra_files_list)
         print("Downloading %u files from repo.hex.pm (from total of %u)" % (len(download_list), total_repo_files))
-        download_files_in_parallel(download_list, num_jobs)
+        use_aria2 = args.aria2 and shutil.which("aria2c") is not None
+        if args.aria2 and not use_aria2:
+            print("aria2c not found. Downloading without it")
+        if use_aria2:
+            if not download_files_with_aria2(download_dir, download_list, num_jobs):
+                print("aria2c failed to download some files. Run again to retry them")
+        else:
+            download_files_in_parallel(download_dir, download_list, num_jobs)
 
     return 0
 